@@ -0,0 +1,183 @@
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+"""
+Distills a trained DuelingDDQN or DQN teacher into a compact student policy
+
+The student sees the camera frame at a lower resolution, uses a thinner conv stack and
+replaces the 6191-wide output layer with a factored head over the curvature x speed
+action grid. It is trained on recorded frames (perf_harness.py record) to match the
+teacher's Q-values or its greedy action, and the script reports how often the student
+picks the teacher's action on held-out frames and how much faster it runs.
+"""
+NUM_CURVATURES = 41  # curvature from -0.2 to 0.2 in steps of 0.01
+NUM_SPEEDS = 151     # speed from 0 to 15 in steps of 0.1
+NUM_ACTIONS = NUM_CURVATURES * NUM_SPEEDS
+
+
+class StudentQNet(nn.Module):
+    """
+    Q(s, (c, v)) = V(s) + A_curvature(s, c) + A_speed(s, v), laid out like the action space
+    of the environment (speed major, curvature minor) so argmax indices match the teacher's
+    """
+    def __init__(self, num_curvatures=NUM_CURVATURES, num_speeds=NUM_SPEEDS, downsample=2):
+        super(StudentQNet, self).__init__()
+        self.num_curvatures = num_curvatures
+        self.num_speeds = num_speeds
+        self.downsample = downsample
+
+        self.conv1 = nn.Conv2d(3, 16, kernel_size=8, stride=4)
+        self.conv2 = nn.Conv2d(16, 32, kernel_size=4, stride=2)
+        self.conv3 = nn.Conv2d(32, 32, kernel_size=3, stride=1)
+        self.pool3 = nn.MaxPool2d(kernel_size=2, stride=2)
+
+        self.flatten_size = self._get_conv_output((3, 200, 320))
+        self.fc1 = nn.Linear(self.flatten_size, 128)
+
+        self.value_stream = nn.Linear(128, 1)
+        self.curvature_stream = nn.Linear(128, num_curvatures)
+        self.speed_stream = nn.Linear(128, num_speeds)
+
+    def _features(self, state):
+        if self.downsample > 1:
+            state = F.avg_pool2d(state, self.downsample)
+        x = F.relu(self.conv1(state))
+        x = F.relu(self.conv2(x))
+        x = F.relu(self.pool3(self.conv3(x)))
+        return x.reshape(x.size(0), -1)
+
+    def _get_conv_output(self, shape):
+        with torch.no_grad():
+            return int(self._features(torch.zeros(1, *shape)).size(1))
+
+    def forward(self, state):
+        state = state.float() / 255.0
+        x = F.relu(self.fc1(self._features(state)))
+
+        value = self.value_stream(x)
+        curvature = self.curvature_stream(x)
+        speed = self.speed_stream(x)
+        curvature = curvature - curvature.mean(dim=1, keepdim=True)
+        speed = speed - speed.mean(dim=1, keepdim=True)
+
+        q_values = value[:, :, None] + speed[:, :, None] + curvature[:, None, :]
+        return q_values.reshape(q_values.size(0), -1)
+
+
+def load_q_network(arch, path, device):
+    if arch == 'd3qn':
+        from lane_keeping_d3qn import DuelingDDQN
+        network = DuelingDDQN(NUM_ACTIONS)
+    else:
+        from lane_keeping_dqn import DQN
+        network = DQN(NUM_ACTIONS)
+    network.load_state_dict(torch.load(path, map_location=device))
+    return network.to(device).eval()
+
+
+def load_frames(paths):
+    """
+    Camera frames of recorded episodes, as (N, 3, H, W) uint8
+    """
+    frames = np.concatenate([np.load(path)['observations'] for path in paths])
+    return torch.from_numpy(frames).permute(0, 3, 1, 2).contiguous()
+
+
+def batched(model, frames, batch_size, device):
+    with torch.no_grad():
+        return torch.cat([model(frames[i:i+batch_size].to(device)).cpu() for i in range(0, len(frames), batch_size)])
+
+
+def count_parameters(model):
+    return sum(param.nelement() for param in model.parameters())
+
+
+def synchronize(device):
+    # CUDA kernels run asynchronously, wait for them before reading the clock
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def latency_ms(model, frame, device, repeats=100):
+    frame = frame.unsqueeze(0).to(device)
+    with torch.no_grad():
+        for _ in range(10):
+            model(frame)
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(frame)
+        synchronize(device)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distill a trained Q-network into a compact student policy')
+    parser.add_argument('--teacher', type=str, required=True,
+                        help='Path to the teacher state dict (.pth)')
+    parser.add_argument('--teacher-arch', type=str, default='d3qn', choices=('d3qn', 'dqn'))
+    parser.add_argument('--frames', type=str, nargs='+', required=True,
+                        help='Recorded episodes (.npz from perf_harness.py record) to train on')
+    parser.add_argument('--output', type=str, default='student_nn_model.pth')
+    parser.add_argument('--loss', type=str, default='q', choices=('q', 'policy'),
+                        help="q: regress the teacher's Q-values, policy: cross-entropy on the teacher's greedy action")
+    parser.add_argument('--downsample', type=int, default=2,
+                        help='Factor the student downsamples the camera frame by')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--holdout', type=float, default=0.1,
+                        help='Fraction of the frames held out to measure agreement')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    teacher = load_q_network(args.teacher_arch, args.teacher, device)
+    student = StudentQNet(downsample=args.downsample).to(device)
+
+    frames = load_frames(args.frames)
+    permutation = torch.randperm(len(frames), generator=torch.Generator().manual_seed(0))
+    num_holdout = max(1, int(len(frames) * args.holdout))
+    holdout_frames = frames[permutation[:num_holdout]]
+    train_frames = frames[permutation[num_holdout:]]
+
+    # the teacher's outputs only need to be computed once
+    teacher_q = batched(teacher, train_frames, args.batch_size, device)
+    teacher_actions = teacher_q.argmax(dim=1)
+    holdout_actions = batched(teacher, holdout_frames, args.batch_size, device).argmax(dim=1)
+
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr)
+    for epoch in range(args.epochs):
+        student.train()
+        order = torch.randperm(len(train_frames))
+        total_loss = 0
+        for i in range(0, len(order), args.batch_size):
+            idx = order[i:i+args.batch_size]
+            student_q = student(train_frames[idx].to(device))
+            if args.loss == 'q':
+                loss = F.smooth_l1_loss(student_q, teacher_q[idx].to(device))
+            else:
+                loss = F.cross_entropy(student_q, teacher_actions[idx].to(device))
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(idx)
+
+        print(f'Epoch {epoch}: loss {total_loss / len(order):.4f}')
+
+    student.eval()
+    agreement = (batched(student, holdout_frames, args.batch_size, device).argmax(dim=1) == holdout_actions).float().mean()
+    torch.save(student.state_dict(), args.output)
+
+    teacher_latency = latency_ms(teacher, holdout_frames[0], device)
+    student_latency = latency_ms(student, holdout_frames[0], device)
+    print(f'Teacher: {count_parameters(teacher)} parameters, {teacher_latency:.2f} ms per frame')
+    print(f'Student: {count_parameters(student)} parameters, {student_latency:.2f} ms per frame')
+    print(f'Agreement with the teacher on {num_holdout} held-out frames: {agreement * 100:.1f}%, '
+          f'speedup {teacher_latency / student_latency:.1f}x')
+    print(f'Saved student to {args.output}')
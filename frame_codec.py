@@ -0,0 +1,104 @@
+import threading
+import time
+import zlib
+import numpy as np
+import cv2
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+"""
+Codecs for storing camera frames in the replay buffer
+
+- lz4 / zlib are lossless byte compressors, quality is the compression level
+- png is lossless, quality is the png compression level (0-9)
+- jpeg is lossy, quality is the jpeg quality (0-100)
+"""
+CODECS = ('lz4', 'zlib', 'png', 'jpeg')
+
+DEFAULT_QUALITY = {
+    'lz4': 0,
+    'zlib': 1,
+    'png': 1,
+    'jpeg': 95,
+}
+
+
+class EncodedFrame:
+    __slots__ = ('data', 'shape', 'dtype')
+
+    def __init__(self, data, shape, dtype):
+        self.data = data
+        self.shape = shape
+        self.dtype = dtype
+
+    def nbytes(self):
+        return len(self.data)
+
+
+class FrameCodec:
+    def __init__(self, codec='lz4', quality=None):
+        if codec not in CODECS:
+            raise ValueError(f"unknown frame codec '{codec}', expected one of {CODECS}")
+        if codec == 'lz4' and lz4 is None:
+            raise ImportError("the lz4 frame codec needs the lz4 package (pip install lz4)")
+
+        self.codec = codec
+        self.quality = DEFAULT_QUALITY[codec] if quality is None else quality
+
+        # compression and decode stats, decode runs on several threads
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.decoded_frames = 0
+        self.decode_time = 0.
+
+    def encode(self, frame):
+        frame = np.ascontiguousarray(frame)
+        if self.codec == 'lz4':
+            data = lz4.frame.compress(frame.tobytes(), compression_level=self.quality)
+        elif self.codec == 'zlib':
+            data = zlib.compress(frame.tobytes(), self.quality)
+        elif self.codec == 'png':
+            _, data = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, self.quality])
+            data = data.tobytes()
+        else:
+            _, data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            data = data.tobytes()
+
+        with self.lock:
+            self.raw_bytes += frame.nbytes
+            self.encoded_bytes += len(data)
+        return EncodedFrame(data, frame.shape, frame.dtype)
+
+    def decode(self, encoded):
+        start = time.perf_counter()
+        # byte codecs decode into a bytearray so the frame stays writable for torch.from_numpy
+        if self.codec == 'lz4':
+            frame = np.frombuffer(bytearray(lz4.frame.decompress(encoded.data)), dtype=encoded.dtype).reshape(encoded.shape)
+        elif self.codec == 'zlib':
+            frame = np.frombuffer(bytearray(zlib.decompress(encoded.data)), dtype=encoded.dtype).reshape(encoded.shape)
+        else:
+            frame = cv2.imdecode(np.frombuffer(encoded.data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            frame = frame.reshape(encoded.shape)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.decoded_frames += 1
+            self.decode_time += elapsed
+        return frame
+
+    def compression_ratio(self):
+        return self.raw_bytes / max(self.encoded_bytes, 1)
+
+    def decode_throughput(self):
+        """
+        Frames decoded per second of decode time on a single worker
+        """
+        return self.decoded_frames / max(self.decode_time, 1e-9)
+
+    def report(self):
+        return (f'{self.codec} (quality {self.quality}): compression ratio {self.compression_ratio():.1f}x, '
+                f'decode {self.decode_throughput():.0f} frames/s per worker')
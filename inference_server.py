@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+"""
+Batched inference server shared by several environment workers
+
+Every worker hands its current observation to the server and blocks until an
+action index comes back. The server thread gathers pending observations until
+either max_batch_size of them are queued or timeout seconds have passed since the
+first one arrived, runs them through a single forward pass of the policy network
+and scatters the chosen action indices back to the workers. Epsilon-greedy
+exploration is applied here with a separate epsilon per worker. If a batch fails,
+its error is raised in every waiting worker and the server stops, so later act()
+calls fail straight away instead of waiting for an answer that never comes.
+"""
+class InferenceRequest:
+    def __init__(self, worker_id, state):
+        self.worker_id = worker_id
+        self.state = state
+        self.action_idx = None
+        self.error = None
+        self.ready = threading.Event()
+
+
+class InferenceServer:
+    def __init__(self, network, num_actions, num_workers, device, max_batch_size=None, timeout=0.005):
+        self.network = network
+        self.num_actions = num_actions
+        self.device = device
+        self.max_batch_size = max_batch_size or num_workers
+        self.timeout = timeout
+
+        # per-worker exploration rate, applied on the server side
+        self.epsilons = np.ones(num_workers)
+
+        self.requests = queue.Queue()
+        self.running = False
+        self.thread = None
+        # set when a batch failed, the server thread has stopped
+        self.error = None
+
+        # throughput stats
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_forwards = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def set_epsilon(self, worker_id, epsilon):
+        self.epsilons[worker_id] = epsilon
+
+    def act(self, worker_id, state):
+        """
+        Called from a worker thread, blocks until the server has picked an action
+        """
+        if self.error is not None:
+            raise RuntimeError('inference server stopped after an error') from self.error
+        request = InferenceRequest(worker_id, state)
+        self.requests.put(request)
+        # a request queued while the server was failing is never served, fail it here
+        while not request.ready.wait(timeout=0.1):
+            if self.error is not None:
+                self._fail_pending(self.error)
+        if request.error is not None:
+            raise RuntimeError('inference server failed on this batch') from request.error
+        return request.action_idx
+
+    def average_batch_size(self):
+        return self.num_requests / max(self.num_batches, 1)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.timeout
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _fail(self, batch, error):
+        for request in batch:
+            request.error = error
+            request.ready.set()
+
+    def _fail_pending(self, error):
+        pending = []
+        while True:
+            try:
+                pending.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        self._fail(pending, error)
+
+    def _serve(self):
+        while self.running:
+            try:
+                first = self.requests.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            batch = self._collect(first)
+            try:
+                self._run(batch)
+            except Exception as error:
+                # stop serving and hand the error to every worker waiting for an action
+                self.error = error
+                self.running = False
+                self._fail(batch, error)
+                self._fail_pending(error)
+
+    def _run(self, batch):
+        # Decide per request whether to explore, only the greedy ones need the network
+        epsilons = self.epsilons[[request.worker_id for request in batch]]
+        explore = np.random.uniform(size=len(batch)) < epsilons
+
+        greedy = [request for request, e in zip(batch, explore) if not e]
+        if greedy:
+            states = torch.cat([request.state for request in greedy]).to(self.device)
+            # camera frames are channels-last, state vectors go in as they are
+            if states.dim() == 4:
+                states = states.permute(0, 3, 1, 2)
+            with torch.no_grad():
+                qs = self.network(states)
+            greedy_idx = qs.argmax(dim=1).cpu().numpy()
+            for request, action_idx in zip(greedy, greedy_idx):
+                request.action_idx = int(action_idx)
+            self.num_forwards += 1
+
+        # Scatter the actions back to the waiting workers
+        for request, e in zip(batch, explore):
+            if e:
+                request.action_idx = np.random.randint(self.num_actions)
+            request.ready.set()
+
+        self.num_batches += 1
+        self.num_requests += len(batch)
@@ -4,15 +4,33 @@ from matplotlib import pyplot as plt
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import numpy as np
-import vista
-from vista.utils import transform
-from vista.entities.agents.Dynamics import tireangle2curvature
-from vista.utils import logging, misc
+try:
+    import vista
+    from vista.utils import transform
+    from vista.entities.agents.Dynamics import tireangle2curvature
+    from vista.utils import logging, misc
+except ImportError:
+    # VISTA is only needed for the live environment, perf_harness.py replays recorded episodes without it
+    vista = None
 import random
 import cv2
 import math
 import json
+import os
+import sys
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from inference_server import InferenceServer
+from frame_codec import CODECS, FrameCodec
+from trace_cache import load_world
+from memory_accounting import (StorageTracker, format_bytes, install_report_signal, memory_report, module_bytes,
+                               optimizer_bytes, parse_size, staging_bytes)
 
 """
 Creating the D3QN class that splits into two streams: advantage and value
@@ -51,7 +69,7 @@ class DuelingDDQN(nn.Module):
             output = self.pool3(output)
             return int(np.prod(output.size()))
 
-    def forward(self, state):
+    def encode(self, state):
         # Convert state to float and scale if necessary
         state = state.float() / 255.0  # Scale images to [0, 1]
 
@@ -59,8 +77,19 @@ class DuelingDDQN(nn.Module):
         x = F.relu(self.pool2(self.conv2(x)))
         x = F.relu(self.pool3(self.conv3(x)))
 
-        # Flatten and pass through fully connected layer
-        x = x.reshape(x.size(0), -1)
+        # Flatten the encoder features
+        return x.reshape(x.size(0), -1)
+
+    def freeze_encoder(self):
+        for layer in (self.conv1, self.conv2, self.conv3):
+            for param in layer.parameters():
+                param.requires_grad = False
+
+    def forward(self, state):
+        # A 2-D state holds encoder features cached by the frozen-encoder mode, only the head runs on them
+        x = state if state.dim() == 2 else self.encode(state)
+
+        # Pass through fully connected layer
         x = F.relu(self.fc1(x))
 
         # Value and advantage streams
@@ -71,6 +100,36 @@ class DuelingDDQN(nn.Module):
         q_values = value + advantage - advantage.mean(dim=1, keepdim=True)
         return q_values
 
+"""
+Dueling MLP Q-network for the low-dimensional state observations (--obs-mode state)
+"""
+STATE_DIM = 7
+
+class MLPQNetwork(nn.Module):
+    def __init__(self, state_dim, action_dim):
+        super(MLPQNetwork, self).__init__()
+        self.fc1 = nn.Linear(state_dim, 256)
+        self.fc2 = nn.Linear(256, 256)
+
+        # State Value stream
+        self.value_stream = nn.Linear(256, 1)
+
+        # Advantage stream
+        self.advantage_stream = nn.Linear(256, action_dim)
+
+    def forward(self, state):
+        x = F.relu(self.fc1(state.float()))
+        x = F.relu(self.fc2(x))
+
+        value = self.value_stream(x)
+        advantage = self.advantage_stream(x)
+        return value + advantage - advantage.mean(dim=1, keepdim=True)
+
+
+def to_network_input(states):
+    # camera frames are stored channels-last for the conv layers, state vectors are used as they are
+    return states.permute(0, 3, 1, 2) if states.dim() == 4 else states
+
 """
 Creating the behavior and target neural networks
 Initializing the loss function and optimizer
@@ -94,16 +153,36 @@ class environment:
             trace_config,
             car_config,
             sensor_config,
-            reward_function
+            reward_function,
+            action_repeat=1,
+            obs_mode='camera',
+            trace_cache_dir=None
     ):
-        self.world = vista.World(trace_paths, trace_config)
+        # the trace cache memory-maps traces preprocessed by earlier runs instead of rebuilding them
+        if trace_cache_dir is not None:
+            self.world = load_world(trace_paths, trace_config, trace_cache_dir)
+        else:
+            self.world = vista.World(trace_paths, trace_config)
         self.agent = self.world.spawn_agent(car_config)
-        self.agent.spawn_camera(sensor_config)
         self.rf = reward_function
 
+        # 'camera' observes the rendered front camera, 'state' a vector of the agent's state and never renders
+        self.obs_mode = obs_mode
+        if obs_mode == 'camera':
+            self.agent.spawn_camera(sensor_config)
+            self.observation_key = 'camera_front'
+        else:
+            self.observation_key = 'state'
+
+        # number of dynamics substeps every action is applied for, the camera only renders after the last one
+        self.action_repeat = action_repeat
+
         self.distance = 0
         self.prev_xy = np.zeros((2, ))
 
+        self.action_space = self.build_action_space()
+
+    def build_action_space(self):
         # creating an action space where curvature ranges from -0.2 to 0.2 and speed ranges from 0 to 15
         curvature_increment = 0.01
         speed_increment = 0.1
@@ -113,16 +192,40 @@ class environment:
 
         curvature_grid, speed_grid = np.meshgrid(curvature_range, speed_range)
 
-        self.action_space = np.stack([curvature_grid.ravel(), speed_grid.ravel()], axis=1)
-
+        return np.stack([curvature_grid.ravel(), speed_grid.ravel()], axis=1)
     
     def reset(self):
         self.world.reset()
         self.agent = self.world.agents[0]
-        observations = self.agent.observations
+        observations = self.observations()
         self.distance = 0
         self.prev_xy = np.zeros((2, ))
         return observations
+
+    def observations(self):
+        if self.obs_mode == 'camera':
+            return self.agent.observations
+        return {'state': self.state_vector()}
+
+    def state_vector(self):
+        """
+        Low-dimensional observation made of the quantities the reward functions use:
+        lateral and longitudinal offset from the road center (in road half widths), relative yaw,
+        heading error to the road direction, steering, speed and the road half width
+        """
+        road_half_width = self.agent.trace.road_width / 2.
+        heading_error = self.agent.ego_dynamics.yaw - self.agent.human_dynamics.yaw
+        heading_error = (heading_error + np.pi) % (2 * np.pi) - np.pi
+
+        return np.array([
+            self.agent.relative_state.x / road_half_width,
+            self.agent.relative_state.y / road_half_width,
+            self.agent.relative_state.yaw,
+            heading_error,
+            self.agent.steering,
+            self.agent.speed,
+            road_half_width
+        ], dtype=np.float32)
     
     def reward_1(self):
         """
@@ -238,39 +341,49 @@ class environment:
 
     
     def step(self, action, dt = 1/30):
-        self.agent.step_dynamics(action, dt=dt)
-        self.agent.step_sensors()
-        next_state = self.agent.observations
+        # Apply the action for action_repeat substeps, summing the rewards and stopping early once done
+        reward = 0
+        for _ in range(self.action_repeat):
+            self.agent.step_dynamics(action, dt=dt)
+
+            # Update car ego info
+            current_xy = self.agent.ego_dynamics.numpy()[:2]
+            self.distance += np.linalg.norm(current_xy - self.prev_xy)
+            self.prev_xy = current_xy
+
+            # Calculate lateral distance from road center
+            lateral_distance = np.abs(self.agent.relative_state.x)
+            road_half_width = self.agent.trace.road_width / 2.
+            
+            # Set a threshold for being too far off the road
+            max_allowed_distance = road_half_width * 3  # Example threshold
+
+            # Check if the agent is too far off the road
+            too_far_off_road = lateral_distance > max_allowed_distance
+            done = self.agent.done or too_far_off_road
+
+            # reward, _ = self.reward_1() if self.rf == 1 else self.reward_2()
+            substep_reward, _ = self.reward_3()
+            reward += substep_reward
+
+            if done:
+                break
+
+        # Only render the camera for the observation the policy acts on
+        if self.obs_mode == 'camera':
+            self.agent.step_sensors()
+        next_state = self.observations()
         
         # get other info
         info = misc.fetch_agent_info(self.agent)
-        
-        # Update car ego info
-        current_xy = self.agent.ego_dynamics.numpy()[:2]
-        self.distance += np.linalg.norm(current_xy - self.prev_xy)
-        self.prev_xy = current_xy
         info['distance'] = self.distance
 
-         # Calculate lateral distance from road center
-        lateral_distance = np.abs(self.agent.relative_state.x)
-        road_half_width = self.agent.trace.road_width / 2.
-        
-        # Set a threshold for being too far off the road
-        max_allowed_distance = road_half_width * 3  # Example threshold
-
-        # Check if the agent is too far off the road
-        too_far_off_road = lateral_distance > max_allowed_distance
-        done = self.agent.done or too_far_off_road
-
-        # reward, _ = self.reward_1() if self.rf == 1 else self.reward_2()
-        reward, _ = self.reward_3()
-
         return next_state, reward, done, info
     
 
     def epsilon_greedy_action(self, state, epsilon):
         # Restructuring the states to match the input of the conv layers
-        state = state.permute(0, 3, 1, 2)
+        state = to_network_input(state)
         prob = np.random.uniform()
         if prob < epsilon:
             action_idx = np.random.randint(len(self.action_space))
@@ -284,21 +397,180 @@ class environment:
 Replay buffer class
 """
 class ReplayBuffer:
-    def __init__(self, capacity):
+    def __init__(self, capacity, max_bytes=None):
+        """
+        With max_bytes the oldest transitions are evicted whenever the buffer holds more than
+        max_bytes, and a capacity of None leaves the number of transitions bounded by max_bytes only
+        """
         self.buffer = deque(maxlen=capacity)
+        # several environment workers may store while the learner samples
+        self.lock = threading.Lock()
+
+        self.tracker = StorageTracker()
+        self.max_bytes = max_bytes
+        self.budget_reached = False
     
     def store(self, experience):
-        self.buffer.append(experience)
+        with self.lock:
+            if self.buffer.maxlen is not None and len(self.buffer) == self.buffer.maxlen:
+                self.tracker.remove(self.buffer.popleft())
+            self.buffer.append(experience)
+            self.tracker.add(experience)
+            if self.max_bytes is not None:
+                self._fit_budget()
+
+    def _fit_budget(self):
+        # the tracker counts every frame once however the transitions sharing it were stored,
+        # so evicting by its byte count holds whichever worker stored them
+        if self.tracker.nbytes > self.max_bytes and not self.budget_reached:
+            self.budget_reached = True
+            print(f'Replay buffer reached its memory budget of {format_bytes(self.max_bytes)} '
+                  f'at {len(self.buffer)} transitions')
+        while self.tracker.nbytes > self.max_bytes and len(self.buffer) > 1:
+            self.tracker.remove(self.buffer.popleft())
     
     def sample(self, batch_size):
-        return random.sample(self.buffer, batch_size)
+        with self.lock:
+            return random.sample(self.buffer, batch_size)
     
     def size(self):
         return len(self.buffer)
 
+    def nbytes(self):
+        return self.tracker.nbytes
+
+
+class CompressedReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer that keeps the camera frames encoded with a FrameCodec
+    Frames of a sampled batch are decoded in a thread pool, and the next batch is
+    already being decoded while the learner runs its update on the current one
+    """
+    def __init__(self, capacity, codec, decode_workers=4, max_bytes=None):
+        super(CompressedReplayBuffer, self).__init__(capacity, max_bytes)
+        self.codec = codec
+        self.pool = ThreadPoolExecutor(max_workers=decode_workers)
+        self.prefetched = None
+        # last stored next_state and its encoding, it comes back as the state of the caller's next
+        # transition; kept per thread since the environment workers of --num-envs store interleaved
+        self.last = threading.local()
+
+    def _encode(self, frame):
+        if frame is None:
+            return None
+        last_frame = getattr(self.last, 'frame', None)
+        if last_frame is not None and frame.untyped_storage().data_ptr() == last_frame.untyped_storage().data_ptr():
+            return self.last.encoded
+        return self.codec.encode(frame[0].cpu().numpy())
+
+    def _decode(self, encoded):
+        return None if encoded is None else torch.from_numpy(self.codec.decode(encoded)).unsqueeze(0)
+
+    def _submit(self, batch_size):
+        transitions = super(CompressedReplayBuffer, self).sample(batch_size)
+        return [(self.pool.submit(self._decode, state), action, reward, self.pool.submit(self._decode, next_state), done)
+                for state, action, reward, next_state, done in transitions]
+
+    def store(self, experience):
+        state, action, reward, next_state, done = experience
+        encoded_state = self._encode(state)
+        encoded_next_state = self._encode(next_state)
+        self.last.frame, self.last.encoded = next_state, encoded_next_state
+        super(CompressedReplayBuffer, self).store((encoded_state, action, reward, encoded_next_state, done))
+
+    def sample(self, batch_size):
+        pending = self.prefetched
+        if pending is None or len(pending) != batch_size:
+            pending = self._submit(batch_size)
+        self.prefetched = self._submit(batch_size)
+        return [(state.result(), action, reward, next_state.result(), done)
+                for state, action, reward, next_state, done in pending]
+
+
+class SharedReplayBuffer:
+    """
+    Replay buffer kept in preallocated shared memory tensors, so that every learner
+    process of the data-parallel mode samples from the transitions stored by rank 0
+    """
+    def __init__(self, capacity, frame_shape):
+        self.capacity = capacity
+        self.states = torch.zeros((capacity, *frame_shape), dtype=torch.uint8).share_memory_()
+        self.next_states = torch.zeros((capacity, *frame_shape), dtype=torch.uint8).share_memory_()
+        self.actions = torch.zeros(capacity, dtype=torch.long).share_memory_()
+        self.rewards = torch.zeros(capacity, dtype=torch.float32).share_memory_()
+        self.dones = torch.zeros(capacity, dtype=torch.bool).share_memory_()
+        self.has_next = torch.zeros(capacity, dtype=torch.bool).share_memory_()
+        # [next write position, number of stored transitions]
+        self.counters = torch.zeros(2, dtype=torch.long).share_memory_()
+
+    def store(self, experience):
+        state, action, reward, next_state, done = experience
+        position = int(self.counters[0])
+        self.states[position] = state[0].cpu()
+        if next_state is not None:
+            self.next_states[position] = next_state[0].cpu()
+        self.has_next[position] = next_state is not None
+        self.actions[position] = int(action)
+        self.rewards[position] = float(reward)
+        self.dones[position] = bool(done)
+        self.counters[0] = (position + 1) % self.capacity
+        self.counters[1] = min(int(self.counters[1]) + 1, self.capacity)
+
+    def sample(self, batch_size):
+        indices = random.sample(range(self.size()), batch_size)
+        return [(self.states[i:i+1], int(self.actions[i]), float(self.rewards[i]),
+                 self.next_states[i:i+1] if self.has_next[i] else None, bool(self.dones[i]))
+                for i in indices]
+
+    def size(self):
+        return int(self.counters[1])
+
+    def nbytes(self):
+        return sum(tensor.nelement() * tensor.element_size()
+                   for tensor in (self.states, self.next_states, self.actions, self.rewards, self.dones, self.has_next))
+
+    @staticmethod
+    def transition_bytes(frame_shape):
+        # two frames, an int64 action, a float32 reward and two bools
+        return 2 * int(np.prod(frame_shape)) + 8 + 4 + 2
+
+
+def encode_replay_buffer(memory):
+    """
+    Replaces the camera frames of a replay buffer with the features of the frozen encoder
+    A frame shared by consecutive transitions is encoded once and its features are shared too
+    """
+    capacity = memory.buffer.maxlen if memory.max_bytes is None else None
+    encoded = ReplayBuffer(capacity, memory.max_bytes)
+    features = {}
+
+    def encode(frame):
+        if frame is None:
+            return None
+        key = frame.untyped_storage().data_ptr()
+        if key not in features:
+            with torch.no_grad():
+                features[key] = behavior_nn.encode(to_network_input(frame.to(device)))
+        return features[key]
+
+    for state, action, reward, next_state, done in memory.buffer:
+        encoded.store((encode(state), action, reward, encode(next_state), done))
+    return encoded
+
 
 Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done'))
 
+
+def average_gradients(model):
+    """
+    All-reduce the gradients of the data-parallel learners so every rank applies the same update
+    """
+    world_size = dist.get_world_size()
+    for param in model.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+            param.grad /= world_size
+
 def optimize_model(memory, batch_size, gamma):
     if memory.size() < batch_size:
         return
@@ -308,11 +580,11 @@ def optimize_model(memory, batch_size, gamma):
 
     # convert to tensors and move to device
     state_batch = torch.cat([s for s in batch.state]).to(device)
-    state_batch = state_batch.permute(0, 3, 1, 2)
+    state_batch = to_network_input(state_batch)
     action_batch = torch.tensor(np.array(batch.action)).to(device).long()
     reward_batch = torch.cat([torch.tensor([r]).to(device) for r in batch.reward])
     next_state_batch = torch.cat([s for s in batch.next_state if s is not None]).to(device)
-    next_state_batch = next_state_batch.permute(0, 3, 1, 2)
+    next_state_batch = to_network_input(next_state_batch)
     non_final_mask = torch.tensor(tuple(map(lambda s: s is not None, batch.next_state)), dtype=torch.bool).to(device)
 
     # Compute Q
@@ -331,8 +603,219 @@ def optimize_model(memory, batch_size, gamma):
     # Optimize the model
     optimizer.zero_grad()
     loss.backward()
+    if dist.is_available() and dist.is_initialized():
+        average_gradients(behavior_nn)
     optimizer.step()
 
+
+def update_networks(replay_buffer, batch_size, gamma, sync_target):
+    # Optimize the model if the replay buffer has enough samples
+    optimize_model(replay_buffer, batch_size, gamma)
+
+    # Update the target network
+    if sync_target:
+        target_nn.load_state_dict(behavior_nn.state_dict())
+
+
+def memory_usage(replay_buffer, batch_size, frame_shape, prefetch=False, num_learners=1):
+    """
+    Components of the memory report, every data-parallel learner holds its own networks,
+    optimizer state and staging buffers for its shard of the minibatch
+    """
+    return {
+        'replay': replay_buffer.nbytes(),
+        'networks': (module_bytes(behavior_nn) + module_bytes(target_nn)) * num_learners,
+        'optimizer': optimizer_bytes(optimizer) * num_learners,
+        'staging': staging_bytes(batch_size // num_learners, frame_shape, prefetch) * num_learners,
+    }
+
+
+def observation_tensor(observation):
+    # Convert an observation to a batch of one on the device
+    return torch.from_numpy(observation).unsqueeze(0).to(device)
+
+
+class TrainingLog:
+    """
+    Per-episode rewards and step counts and the best target network so far,
+    saved with the trained target network at the end of training
+    """
+    def __init__(self):
+        self.rewards = []
+        self.eps = []
+        self.num_steps = []
+        self.best_dict = {}
+        self.best_dict_reward = -1e10
+
+    def add(self, total_reward, step):
+        episode = len(self.eps)
+        self.rewards.append(total_reward)
+        self.eps.append(episode)
+        self.num_steps.append(step)
+
+        if total_reward > self.best_dict_reward:
+            self.best_dict = target_nn.state_dict()
+            self.best_dict_reward = total_reward
+        return episode
+
+    def save(self):
+        # Save the model's state dictionary
+        torch.save(target_nn.state_dict(), 'r2_trained_target_nn.pth')
+        torch.save(self.best_dict, '_best_dqn_network_nn_model.pth')
+
+        data = {
+            "rewards": self.rewards,
+            "episodes": self.eps,
+            "steps": self.num_steps
+        }
+
+        # Write the data to a JSON file
+        with open('training_data.json', 'w') as file:
+            json.dump(data, file, indent=4)
+
+
+def run_episode(env, epsilon, max_steps, target_update, store, update, to_state_tensor=observation_tensor):
+    """
+    Plays one epsilon-greedy episode, handing every transition to store and calling update(sync_target)
+    after every step to train on the replay buffer and sync the target network when sync_target is set
+    Returns the total reward and the number of steps
+    """
+    state = env.reset()[env.observation_key]
+    total_reward = 0
+    done = False
+    step = 0
+
+    # Convert state to the appropriate format and move to device
+    state_tensor = to_state_tensor(state)
+
+    while not done:
+        # Select action using epsilon greedy policy
+        action_idx = env.epsilon_greedy_action(state_tensor, epsilon)
+        next_state, reward, done, _ = env.step(env.action_space[action_idx])
+        next_state = next_state[env.observation_key]
+
+        # Convert next_state to tensor and move to device
+        next_state_tensor = to_state_tensor(next_state) if next_state is not None else None
+
+        # Store the transition in the replay buffer
+        store((state_tensor, action_idx, reward, next_state_tensor, done))
+
+        # Reuse the tensor so the replay buffer keeps a single copy of each frame
+        state_tensor = next_state_tensor
+        total_reward += reward
+
+        # Optimize the model and update the target network
+        update(step % target_update == 0)
+
+        if step > max_steps:
+            break
+
+        step += 1
+
+    return total_reward, step
+
+
+def train_episodes(env, log, num_episodes, epsilon_start, epsilon_end, epsilon_decay, max_steps, target_update,
+                   store, update, to_state_tensor=observation_tensor, before_episode=None, after_episode=None):
+    """
+    Episode loop shared by the single-process mode and rank 0 of the data-parallel mode
+    before_episode(episode) and after_episode(episode) add the caller's own per-episode work
+    """
+    epsilon = epsilon_start
+    for episode in range(num_episodes):
+        if before_episode is not None:
+            before_episode(episode)
+
+        total_reward, step = run_episode(env, epsilon, max_steps, target_update, store, update, to_state_tensor)
+        log.add(total_reward, step)
+
+        print(f'Episode {episode}: Total Reward: {total_reward}, Epsilon: {epsilon}, NumSteps: {step}')
+        if after_episode is not None:
+            after_episode(episode)
+
+        # Update epsilon
+        epsilon = max(epsilon_end, epsilon_decay * epsilon)
+
+
+def train_data_parallel(rank, world_size, args, trace_config, car_config, sensor_config, replay_buffer,
+                        batch_size, gamma, epsilon_start, epsilon_end, epsilon_decay, num_episodes,
+                        target_update, max_steps):
+    """
+    Data-parallel learner process, started once per rank by torch.multiprocessing.spawn
+
+    Rank 0 steps the environment and fills the shared replay buffer. Before every update it
+    broadcasts a control tensor, then all ranks sample their own shard of the minibatch,
+    all-reduce their gradients and step their optimizers. Since all ranks start from rank 0's
+    weights and apply the same averaged gradients, the networks stay identical, so target
+    syncs happen on the same update everywhere and only rank 0 writes checkpoints.
+    """
+    frame_shape = sensor_config['size'] + (3,)
+
+    def memory_components():
+        return memory_usage(replay_buffer, batch_size, frame_shape, num_learners=world_size)
+
+    # the launching process forwards SIGUSR1 to rank 0, which reports the memory of all learners
+    if rank == 0:
+        install_report_signal(lambda: memory_report(memory_components()))
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.master_port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    # split the cores between the learner processes instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    for param in behavior_nn.parameters():
+        dist.broadcast(param.data, src=0)
+    target_nn.load_state_dict(behavior_nn.state_dict())
+
+    shard_size = batch_size // world_size
+
+    # [keep running, sync target network, replay size seen by rank 0]
+    control = torch.zeros(3, dtype=torch.long)
+
+    def apply_control():
+        # every rank runs the update described by the control tensor it just received
+        if control[2] >= shard_size:
+            optimize_model(replay_buffer, shard_size, gamma)
+        if control[1]:
+            target_nn.load_state_dict(behavior_nn.state_dict())
+
+    if rank != 0:
+        while True:
+            dist.broadcast(control, src=0)
+            if control[0] == 0:
+                break
+            apply_control()
+        dist.destroy_process_group()
+        return
+
+    def learner_update(sync_target):
+        control[0] = 1
+        control[1] = int(sync_target)
+        control[2] = replay_buffer.size()
+        dist.broadcast(control, src=0)
+        apply_control()
+
+    env = environment(args.trace_path, trace_config, car_config, sensor_config, args.reward_function, args.action_repeat,
+                      trace_cache_dir=args.trace_cache)
+
+    def after_episode(episode):
+        if (episode + 1) % args.memory_report_every == 0:
+            print(memory_report(memory_components()))
+
+    log = TrainingLog()
+    train_episodes(env, log, num_episodes, epsilon_start, epsilon_end, epsilon_decay, max_steps, target_update,
+                   replay_buffer.store, learner_update, after_episode=after_episode)
+
+    # tell the other ranks to stop
+    control[0] = 0
+    dist.broadcast(control, src=0)
+
+    log.save()
+    dist.destroy_process_group()
+
+
 if __name__ == '__main__':
     """
     Defining environment configurations 
@@ -349,8 +832,105 @@ if __name__ == '__main__':
                         help='Choose reward function 1 for standard or 2 for advanced',
                         required=True
                         )
+    parser.add_argument('--num-envs',
+                        type=int,
+                        default=1,
+                        help='Number of environment workers sharing one batched inference server')
+    parser.add_argument('--inference-timeout',
+                        type=float,
+                        default=0.005,
+                        help='Seconds the inference server waits to fill a batch before running it')
+    parser.add_argument('--frame-codec',
+                        type=str,
+                        default='none',
+                        choices=('none',) + CODECS,
+                        help='Compress camera frames stored in the replay buffer')
+    parser.add_argument('--frame-quality',
+                        type=int,
+                        default=None,
+                        help='Compression level (lz4/zlib/png) or jpeg quality for --frame-codec')
+    parser.add_argument('--decode-workers',
+                        type=int,
+                        default=4,
+                        help='Threads decoding sampled frames when --frame-codec is set')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=128,
+                        help='Minibatch size of an update, split evenly between the learners with --num-learners')
+    parser.add_argument('--num-learners',
+                        type=int,
+                        default=1,
+                        help='Number of data-parallel learner processes (torch.distributed, gloo backend)')
+    parser.add_argument('--master-port',
+                        type=int,
+                        default=29500,
+                        help='Port used by the learner processes to rendezvous with --num-learners')
+    parser.add_argument('--memory-budget',
+                        type=str,
+                        default=None,
+                        help='Memory for replay, networks, optimizer and staging buffers, e.g. 16G; '
+                             'old replay transitions are evicted to stay within it')
+    parser.add_argument('--memory-report-every',
+                        type=int,
+                        default=10,
+                        help='Print a memory report every N episodes (send SIGUSR1 for one on demand)')
+    parser.add_argument('--action-repeat',
+                        type=int,
+                        default=1,
+                        help='Apply every action for k dynamics substeps and only render the camera after the last one')
+    parser.add_argument('--obs-mode',
+                        type=str,
+                        default='camera',
+                        choices=('camera', 'state'),
+                        help='camera: learn from the rendered camera with the conv network, '
+                             'state: learn from a low-dimensional state vector with an MLP and never render')
+    parser.add_argument('--frozen-encoder',
+                        type=str,
+                        default=None,
+                        help='Load the conv encoder from this trained model, freeze it and only train the Q-head '
+                             'on encoder features cached in the replay buffer')
+    parser.add_argument('--freeze-after',
+                        type=int,
+                        default=None,
+                        help='Train the whole network for N warm-up episodes, then freeze the encoder and cache features')
+    parser.add_argument('--trace-cache',
+                        type=str,
+                        default=None,
+                        help='Directory of preprocessed traces, keyed by trace path, modification time and trace config; '
+                             'missing traces are built once and memory-mapped by later runs and workers')
     args = parser.parse_args()
 
+    if args.num_learners < 1:
+        parser.error('--num-learners must be at least 1')
+    if args.num_learners > 1 and (args.num_envs > 1 or args.frame_codec != 'none'):
+        parser.error('--num-learners cannot be combined with --num-envs or --frame-codec')
+    if args.batch_size % args.num_learners != 0:
+        parser.error('--batch-size must be divisible by --num-learners')
+    if args.action_repeat < 1:
+        parser.error('--action-repeat must be at least 1')
+    if args.memory_report_every < 1:
+        parser.error('--memory-report-every must be at least 1')
+    memory_budget = None
+    if args.memory_budget is not None:
+        try:
+            memory_budget = parse_size(args.memory_budget)
+        except ValueError:
+            parser.error(f'--memory-budget {args.memory_budget!r} is not a size like 512M, 16G or 1.5GiB')
+    if args.obs_mode == 'state' and (args.num_learners > 1 or args.frame_codec != 'none'):
+        parser.error('--obs-mode state cannot be combined with --num-learners or --frame-codec')
+
+    if (args.frozen_encoder is not None or args.freeze_after is not None) and \
+            (args.obs_mode == 'state' or args.num_learners > 1 or args.frame_codec != 'none'):
+        parser.error('--frozen-encoder and --freeze-after cannot be combined with --obs-mode state, '
+                     '--num-learners or --frame-codec')
+    if args.freeze_after is not None and (args.frozen_encoder is not None or args.num_envs > 1):
+        parser.error('--freeze-after cannot be combined with --frozen-encoder or --num-envs')
+
+    if args.obs_mode == 'state':
+        behavior_nn = MLPQNetwork(STATE_DIM, 6191).to(device)
+        target_nn = MLPQNetwork(STATE_DIM, 6191).to(device)
+        optimizer = torch.optim.Adam(behavior_nn.parameters(), lr=1e-5)
+
     trace_config={'road_width': 4}
     car_config={
             'length': 5.,
@@ -362,16 +942,13 @@ if __name__ == '__main__':
     sensor_config={
         'size': (200, 320),
     }
-
-    env = environment(args.trace_path, trace_config, car_config, sensor_config, args.reward_function)
-    display = vista.Display(env.world)
+    frame_shape = sensor_config['size'] + (3,) if args.obs_mode == 'camera' else (STATE_DIM,)
 
 
     """
     Initializing hyper-parameters and beginning the training loop
     """
-    replay_buffer = ReplayBuffer(10000)
-    batch_size = 128
+    batch_size = args.batch_size
     gamma = 0.99 
     epsilon_start = 1.0
     epsilon_end = 0.01
@@ -380,90 +957,191 @@ if __name__ == '__main__':
     target_update = 10  # Update target network every 10 episodes
     max_steps = 700
 
-    best_dict = {}
-    best_dict_reward = -1e10
-
-    # per episode
-    rewards = []
-    eps = []
-    num_steps = []
-
-    epsilon = epsilon_start
-    for episode in range(num_episodes):
-        state = env.reset()['camera_front']
-        # print(state)
-        display.reset()
-        total_reward = 0
-        done = False
-        step = 0
-
-        while not done:
-            # Convert state to the appropriate format and move to device
-            state_tensor = torch.from_numpy(state).unsqueeze(0).to(device)
-
-            # Select action using epsilon greedy policy
-            action_idx = env.epsilon_greedy_action(state_tensor, epsilon)
-            next_state, reward, done, _ = env.step(env.action_space[action_idx])
-            next_state = next_state['camera_front']
-
-            # Convert next_state to tensor and move to device
-            next_state_tensor = torch.from_numpy(next_state).unsqueeze(0).to(device) if next_state is not None else None
-
-            # Store the transition in the replay buffer
-            replay_buffer.store((state_tensor, action_idx, reward, next_state_tensor, done))
-
-            state = next_state
-            total_reward += reward
-
-            # Optimize the model if the replay buffer has enough samples
-            optimize_model(replay_buffer, batch_size, gamma)
-
-            # Update the target network
-            if step % target_update == 0:
+    # bytes that are not replay: both networks, the optimizer state and the minibatch staging buffers
+    fixed_bytes = (module_bytes(behavior_nn) + module_bytes(target_nn) + optimizer_bytes(optimizer) +
+                   staging_bytes(batch_size // args.num_learners, frame_shape, prefetch=args.frame_codec != 'none'))
+    replay_budget = None
+    if memory_budget is not None:
+        replay_budget = memory_budget - fixed_bytes * args.num_learners
+        if replay_budget <= 0:
+            parser.error(f'--memory-budget is too small, networks, optimizer and staging buffers alone need '
+                         f'{format_bytes(fixed_bytes * args.num_learners)}')
+
+    if args.num_learners > 1:
+        capacity = 10000
+        if replay_budget is not None:
+            capacity = int(replay_budget // SharedReplayBuffer.transition_bytes(frame_shape))
+            print(f'Replay capacity from memory budget: {capacity} transitions')
+        replay_buffer = SharedReplayBuffer(capacity, frame_shape)
+        learners = mp.spawn(train_data_parallel,
+                            args=(args.num_learners, args, trace_config, car_config, sensor_config, replay_buffer,
+                                  batch_size, gamma, epsilon_start, epsilon_end, epsilon_decay, num_episodes,
+                                  target_update, max_steps),
+                            nprocs=args.num_learners,
+                            join=False)
+        # memory reports come from rank 0, forward the on-demand requests sent to this process
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: os.kill(learners.processes[0].pid, signal.SIGUSR1))
+        while not learners.join():
+            pass
+        sys.exit(0)
+
+    envs = [environment(args.trace_path, trace_config, car_config, sensor_config, args.reward_function, args.action_repeat,
+                        args.obs_mode, args.trace_cache)
+            for _ in range(args.num_envs)]
+    env = envs[0]
+    display = vista.Display(env.world) if args.obs_mode == 'camera' else None
+
+    # with a memory budget the oldest transitions are evicted once the stored ones reach it
+    capacity = 10000 if replay_budget is None else None
+    if args.frame_codec == 'none':
+        replay_buffer = ReplayBuffer(capacity, replay_budget)
+    else:
+        replay_buffer = CompressedReplayBuffer(capacity, FrameCodec(args.frame_codec, args.frame_quality),
+                                               args.decode_workers, replay_budget)
+
+    def memory_components():
+        return memory_usage(replay_buffer, batch_size, frame_shape, prefetch=args.frame_codec != 'none')
+
+    install_report_signal(lambda: memory_report(memory_components()))
+
+    # With a frozen encoder the replay buffer stores encoder features instead of camera frames
+    encoder_frozen = False
+    if args.frozen_encoder is not None:
+        pretrained = torch.load(args.frozen_encoder, map_location=device)
+        result = behavior_nn.load_state_dict({name: value for name, value in pretrained.items() if name.startswith('conv')},
+                                             strict=False)
+        missing = [name for name in result.missing_keys if name.startswith('conv')]
+        if missing:
+            parser.error(f'--frozen-encoder {args.frozen_encoder} has no {", ".join(missing)}')
+        behavior_nn.freeze_encoder()
+        target_nn.load_state_dict(behavior_nn.state_dict())
+        encoder_frozen = True
+
+    def to_state_tensor(observation):
+        # Convert the observation to a batch of one on the device, encoded once here if the encoder is frozen
+        state_tensor = observation_tensor(observation)
+        if encoder_frozen:
+            with torch.no_grad():
+                state_tensor = behavior_nn.encode(to_network_input(state_tensor))
+        return state_tensor
+
+    log = TrainingLog()
+
+    def after_episode(episode):
+        if isinstance(replay_buffer, CompressedReplayBuffer):
+            print(f'Replay frames: {replay_buffer.codec.report()}')
+        if (episode + 1) % args.memory_report_every == 0:
+            print(memory_report(memory_components()))
+
+    if args.num_envs > 1:
+        """
+        Several environment workers step in their own threads and get their actions from one
+        batched inference server, while this thread keeps running optimization steps
+        """
+        server = InferenceServer(behavior_nn, len(env.action_space), args.num_envs, device,
+                                 timeout=args.inference_timeout)
+        finished_episodes = queue.Queue()
+        stop_workers = threading.Event()
+
+        def run_worker(worker_id, worker_env):
+            try:
+                worker_epsilon = epsilon_start
+                server.set_epsilon(worker_id, worker_epsilon)
+                while not stop_workers.is_set():
+                    state = worker_env.reset()[worker_env.observation_key]
+                    state_tensor = to_state_tensor(state)
+                    total_reward = 0
+                    done = False
+                    step = 0
+
+                    while not done and not stop_workers.is_set():
+                        action_idx = server.act(worker_id, state_tensor)
+                        next_state, reward, done, _ = worker_env.step(worker_env.action_space[action_idx])
+                        next_state = next_state[worker_env.observation_key]
+                        next_state_tensor = to_state_tensor(next_state) if next_state is not None else None
+
+                        replay_buffer.store((state_tensor, action_idx, reward, next_state_tensor, done))
+
+                        state = next_state
+                        state_tensor = next_state_tensor
+                        total_reward += reward
+                        if step > max_steps:
+                            break
+                        step += 1
+
+                    finished_episodes.put((worker_id, total_reward, step, worker_epsilon))
+                    worker_epsilon = max(epsilon_end, epsilon_decay * worker_epsilon)
+                    server.set_epsilon(worker_id, worker_epsilon)
+            except Exception as error:
+                # hand the error to the learner, it would otherwise keep waiting for this worker's episodes
+                finished_episodes.put(error)
+
+        server.start()
+        workers = [threading.Thread(target=run_worker, args=(worker_id, worker_env), daemon=True)
+                   for worker_id, worker_env in enumerate(envs)]
+        for worker in workers:
+            worker.start()
+
+        updates = 0
+        start_time = time.time()
+        try:
+            while len(log.eps) < num_episodes:
+                if replay_buffer.size() < batch_size:
+                    time.sleep(0.01)
+                else:
+                    optimize_model(replay_buffer, batch_size, gamma)
+                    updates += 1
+                    if updates % target_update == 0:
+                        target_nn.load_state_dict(behavior_nn.state_dict())
+
+                while not finished_episodes.empty() and len(log.eps) < num_episodes:
+                    finished = finished_episodes.get()
+                    if isinstance(finished, Exception):
+                        raise finished
+                    worker_id, total_reward, step, worker_epsilon = finished
+                    episode = log.add(total_reward, step)
+
+                    print(f'Episode {episode} (worker {worker_id}): Total Reward: {total_reward}, Epsilon: {worker_epsilon}, NumSteps: {step}')
+                    after_episode(episode)
+        finally:
+            # the server keeps answering until every worker has finished its current step
+            stop_workers.set()
+            for worker in workers:
+                worker.join()
+            server.stop()
+
+        elapsed = time.time() - start_time
+        print(f'Actor throughput: {server.num_requests / elapsed:.1f} steps/s, '
+              f'average inference batch: {server.average_batch_size():.2f}')
+
+    else:
+        def learner_update(sync_target):
+            update_networks(replay_buffer, batch_size, gamma, sync_target)
+
+        def before_episode(episode):
+            global replay_buffer, encoder_frozen
+            if episode == args.freeze_after:
+                # End of the warm-up: freeze the encoder and swap the stored frames for their features
+                behavior_nn.freeze_encoder()
                 target_nn.load_state_dict(behavior_nn.state_dict())
+                replay_buffer = encode_replay_buffer(replay_buffer)
+                encoder_frozen = True
+                print(f'Froze the encoder after {episode} episodes, {memory_report(memory_components())}')
+            if display is not None:
+                display.reset()
 
-            if step > max_steps:
-                break
-
-            step += 1
+        start_time = time.time()
+        # replay_buffer is looked up on every store, before_episode may replace it
+        train_episodes(env, log, num_episodes, epsilon_start, epsilon_end, epsilon_decay, max_steps, target_update,
+                       lambda transition: replay_buffer.store(transition), learner_update, to_state_tensor,
+                       before_episode, after_episode)
 
-            # vis_img = display.render()
-            # cv2.imshow(f'Car Agent in Episode {episode}', vis_img[:, :, ::-1])
-            # cv2.waitKey(20)
-
-            # if done:
-            #     # Close the window if the episode is done
-            #     cv2.destroyWindow(f'Car Agent in Episode {episode}')
-            #     break
-
-        rewards.append(total_reward)
-        eps.append(episode)
-        num_steps.append(step)
-
-        if total_reward > best_dict_reward:
-            best_dict = target_nn.state_dict()
-            best_dict_reward = total_reward
-
-        print(f'Episode {episode}: Total Reward: {total_reward}, Epsilon: {epsilon}, NumSteps: {step}')
-
-        # Update epsilon
-        epsilon = max(epsilon_end, epsilon_decay * epsilon)
-        
-    
-    # Save the model's state dictionary
-    torch.save(target_nn.state_dict(), 'r2_trained_target_nn.pth')
-    torch.save(best_dict, '_best_dqn_network_nn_model.pth')
-
-    data = {
-        "rewards": rewards,
-        "episodes": eps,
-        "steps": num_steps
-    }
+        # same figure as the --num-envs mode reports, to compare the two
+        print(f'Actor throughput: {sum(log.num_steps) / (time.time() - start_time):.1f} steps/s')
 
-    # Write the data to a JSON file
-    with open('training_data.json', 'w') as file:
-        json.dump(data, file, indent=4)
+    log.save()
 
     # eps = np.arange(0, num_episodes)
-    print(f"rewards = {rewards}")
-    print(f"num_steps = {num_steps}")
+    print(f"rewards = {log.rewards}")
+    print(f"num_steps = {log.num_steps}")
@@ -4,15 +4,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-import vista
 from copy import deepcopy
-from vista.utils import transform
-from vista.entities.agents.Dynamics import tireangle2curvature
-from vista.utils import logging, misc
+try:
+    import vista
+    from vista.utils import transform
+    from vista.entities.agents.Dynamics import tireangle2curvature
+    from vista.utils import logging, misc
+except ImportError:
+    # VISTA is only needed for the live environment, distill.py and quantize.py only use the networks
+    vista = None
 import random
 import cv2
 import matplotlib.pyplot as plt
 import math
+from video_recorder import VideoRecorder
 
 from warnings import filterwarnings
 filterwarnings(action='ignore', category=DeprecationWarning, message='In future, it will be an error for \'np.bool_\' scalars to be interpreted as an index')
@@ -319,7 +324,24 @@ if __name__ == '__main__':
                         nargs='+',
                         help='Path to the saved model state',
                         required=False)
+    parser.add_argument('--record',
+                        type=str,
+                        default=None,
+                        help='If operation == load, encode the rendered evaluation to this MP4 file in a background process')
+    parser.add_argument('--record-every',
+                        type=int,
+                        default=1,
+                        help='Only render and record every k-th step')
+    parser.add_argument('--record-fps',
+                        type=float,
+                        default=30,
+                        help='Frame rate of the recorded video')
+    parser.add_argument('--headless',
+                        action='store_true',
+                        help='Do not show the evaluation in an OpenCV window')
     args = parser.parse_args()
+    if args.record_every < 1:
+        parser.error('--record-every must be at least 1')
     trace_config={'road_width': 4}
     car_config={
             'length': 5.,
@@ -447,33 +469,45 @@ if __name__ == '__main__':
         target_network.load_state_dict(torch.load(args.save_path[0]))
         target_network.eval()
         max_num_steps = 1000
-        state = env.reset()['camera_front']
-        display.reset()
-        total_reward = 0
-        done = False
-        step = 0
-        while step < max_num_steps and not done:
-            # Convert state to the appropriate format and move to device
-            state_tensor = torch.from_numpy(state).unsqueeze(0).to(device)
-            q_values = target_network(state_tensor.permute(0, 3, 1, 2)).cpu().data.numpy()
-            action = env.action_space[np.argmax(q_values)]
-
-            next_state, reward, done, _ = env.step(action)
-            next_state = next_state['camera_front']
-
-            # Convert next_state to tensor and move to device
-            next_state_tensor = torch.from_numpy(next_state).unsqueeze(0).to(device) if next_state is not None else None
-            next_state_tensor.to(device)
-
-            state = next_state
-
-            vis_img = display.render()
-
-            total_reward += reward
-
-            step += 1
-            cv2.imshow(f'Evaluating Car Agent', vis_img[:, :, ::-1])
-            cv2.waitKey(5)
-        print(f"Total reward = {total_reward}; Steps = {step}")
+        recorder = VideoRecorder(args.record, args.record_fps, args.record_every) if args.record else None
+        try:
+            state = env.reset()['camera_front']
+            display.reset()
+            total_reward = 0
+            done = False
+            step = 0
+            while step < max_num_steps and not done:
+                # Convert state to the appropriate format and move to device
+                state_tensor = torch.from_numpy(state).unsqueeze(0).to(device)
+                q_values = target_network(state_tensor.permute(0, 3, 1, 2)).cpu().data.numpy()
+                action = env.action_space[np.argmax(q_values)]
+
+                next_state, reward, done, _ = env.step(action)
+                next_state = next_state['camera_front']
+
+                # Convert next_state to tensor and move to device
+                next_state_tensor = torch.from_numpy(next_state).unsqueeze(0).to(device) if next_state is not None else None
+                next_state_tensor.to(device)
+
+                state = next_state
+
+                # Only render when the frame is shown or recorded, encoding happens in the recorder's process
+                record_frame = recorder is not None and recorder.wants(step)
+                if record_frame or not args.headless:
+                    vis_img = display.render()
+                if record_frame:
+                    recorder.write(vis_img)
+
+                total_reward += reward
+
+                step += 1
+                if not args.headless:
+                    cv2.imshow(f'Evaluating Car Agent', vis_img[:, :, ::-1])
+                    cv2.waitKey(5)
+            print(f"Total reward = {total_reward}; Steps = {step}")
+        finally:
+            # finish the video even when the evaluation fails or is interrupted
+            if recorder is not None:
+                recorder.close()
     else:   
         print("incorrect operation command, only 'new' or 'load' allowed")
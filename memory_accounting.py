@@ -0,0 +1,152 @@
+import signal
+import sys
+import numpy as np
+import torch
+
+"""
+Memory accounting for the training process
+
+Counts the bytes held by the replay buffer, the networks, the optimizer state and the
+minibatch staging buffers, and parses the --memory-budget option of the training script.
+Tensors are counted by their underlying storage, so a camera frame shared by two
+consecutive transitions (next_state of one, state of the next) is only counted once.
+"""
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_size(text):
+    """
+    Parses sizes like '512M', '16G' or '1.5GiB' into bytes
+    """
+    text = text.strip().upper()
+    for suffix in ('IB', 'B'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            break
+    unit = text[-1] if text and text[-1] in UNITS else ''
+    number = text[:-1] if unit else text
+    return int(float(number) * UNITS[unit])
+
+
+def format_bytes(num_bytes):
+    for unit in ('', 'K', 'M', 'G'):
+        if abs(num_bytes) < 1024:
+            return f'{num_bytes:.1f} {unit}B'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f} TB'
+
+
+def object_storages(obj):
+    """
+    Yields (key, nbytes) for every buffer held by a (nested) transition
+    """
+    if isinstance(obj, torch.Tensor):
+        storage = obj.untyped_storage()
+        yield ('tensor', str(obj.device), storage.data_ptr()), storage.nbytes()
+    elif isinstance(obj, np.ndarray):
+        base = obj if obj.base is None else obj.base
+        if isinstance(base, np.ndarray):
+            yield ('array', base.__array_interface__['data'][0]), base.nbytes
+        else:
+            yield ('array', obj.__array_interface__['data'][0]), obj.nbytes
+    elif isinstance(obj, (tuple, list)):
+        for item in obj:
+            yield from object_storages(item)
+    elif hasattr(obj, 'nbytes') and callable(obj.nbytes):
+        # encoded frames of a FrameCodec
+        yield ('encoded', id(obj)), obj.nbytes()
+
+
+def object_overhead(obj):
+    """
+    Python object overhead of a transition tuple and its scalars
+    """
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(object_overhead(item) for item in obj)
+    if isinstance(obj, (int, float, bool, np.generic)):
+        return sys.getsizeof(obj)
+    return 0
+
+
+class StorageTracker:
+    """
+    Reference counts the storages held by a container so shared buffers are counted once
+    """
+    def __init__(self):
+        self.refs = {}
+        self.nbytes = 0
+
+    def add(self, obj):
+        self.nbytes += object_overhead(obj)
+        for key, nbytes in object_storages(obj):
+            if key in self.refs:
+                self.refs[key][1] += 1
+            else:
+                self.refs[key] = [nbytes, 1]
+                self.nbytes += nbytes
+
+    def remove(self, obj):
+        self.nbytes -= object_overhead(obj)
+        for key, _ in object_storages(obj):
+            entry = self.refs.get(key)
+            if entry is None:
+                continue
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.nbytes -= entry[0]
+                del self.refs[key]
+
+
+def module_bytes(model):
+    seen = set()
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        for key, nbytes in object_storages(tensor):
+            if key not in seen:
+                seen.add(key)
+                total += nbytes
+    return total
+
+
+def optimizer_bytes(optimizer):
+    """
+    Bytes held by the optimizer state. Adam allocates its two moment estimates on the
+    first step, before that they are estimated as twice the size of the parameters
+    """
+    total = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if isinstance(value, torch.Tensor):
+                total += value.nelement() * value.element_size()
+    if total == 0:
+        for group in optimizer.param_groups:
+            for param in group['params']:
+                total += 2 * param.nelement() * param.element_size()
+    return total
+
+
+def staging_bytes(batch_size, frame_shape, prefetch=False):
+    """
+    Minibatch buffers of one update: the uint8 state and next_state batches plus the float
+    copies the networks make of them. A prefetching replay buffer holds one more batch.
+    Activations and gradients of the forward/backward pass are not included.
+    """
+    batch_bytes = batch_size * int(np.prod(frame_shape))
+    total = 2 * batch_bytes + 2 * batch_bytes * 4
+    if prefetch:
+        total += 2 * batch_bytes
+    return total
+
+
+def memory_report(components):
+    total = sum(components.values())
+    parts = ', '.join(f'{name} {format_bytes(nbytes)}' for name, nbytes in components.items())
+    return f'Memory: {format_bytes(total)} total ({parts})'
+
+
+def install_report_signal(report_fn):
+    """
+    Prints report_fn() whenever the process receives SIGUSR1 (kill -USR1 <pid>)
+    """
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print(report_fn(), flush=True))
@@ -0,0 +1,274 @@
+import argparse
+import json
+import multiprocessing as mp
+import random
+import resource
+import sys
+import time
+import numpy as np
+import torch
+
+import lane_keeping_d3qn as ld
+
+"""
+End-to-end performance regression harness
+
+record: runs one canonical episode in the live VISTA environment and saves the seed,
+        the action_idx sequence, the observations and the per-step rewards, dones and distances
+replay: replays that episode deterministically through the training loop's run_episode
+        (step -> store -> optimize_model) without VISTA, reports steps/sec, update latency percentiles and peak RSS, and exits
+        non-zero when any of them regressed past --threshold against a stored baseline
+
+The first --warmup-updates updates (Adam state allocation, allocator and thread pool warm-up)
+are not measured, and the replay is repeated in --repeats fresh processes with the median of
+every metric reported. A metric regresses when its median moved past --threshold and its runs
+no longer overlap the runs of the baseline, so run-to-run noise alone does not fail the check.
+"""
+NUM_ACTIONS = 6191
+TARGET_UPDATE = 10  # target network sync period of lane_keeping_d3qn.py
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    # start from the same weights on every run
+    ld.behavior_nn.load_state_dict(ld.DuelingDDQN(NUM_ACTIONS).state_dict())
+    ld.target_nn.load_state_dict(ld.behavior_nn.state_dict())
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class RecordedEnvironment(ld.environment):
+    """
+    Serves the observations, rewards and dones of a recorded episode in place of VISTA
+    The policy still runs its forward pass on every step, but the recorded actions are taken
+    """
+    def __init__(self, episode):
+        self.observation_key = 'camera_front'
+        self.recorded_actions = episode['action_idx']
+        self.recorded_observations = episode['observations']
+        self.rewards = episode['rewards']
+        self.dones = episode['dones']
+        self.distances = episode['distances']
+        self.t = 0
+        self.distance = 0
+        self.action_space = self.build_action_space()
+
+    def reset(self):
+        self.t = 0
+        self.distance = 0
+        return {'camera_front': self.recorded_observations[0]}
+
+    def epsilon_greedy_action(self, state, epsilon):
+        # pay for the policy forward like the training loop does, but follow the recorded actions
+        super(RecordedEnvironment, self).epsilon_greedy_action(state, 0.)
+        return int(self.recorded_actions[self.t])
+
+    def step(self, action, dt = 1/30):
+        t = self.t
+        self.t += 1
+        self.distance = float(self.distances[t])
+        info = {'distance': self.distance}
+        # the recording may have stopped at its step limit, the episode ends with it either way
+        done = bool(self.dones[t]) or self.t == len(self.recorded_actions)
+        return {'camera_front': self.recorded_observations[t + 1]}, float(self.rewards[t]), done, info
+
+
+def record(args):
+    trace_config = {'road_width': 4}
+    car_config = {
+        'length': 5.,
+        'width': 2.,
+        'wheel_base': 2.78,
+        'steering_ratio': 14.7,
+        'lookahead_road': True
+    }
+    sensor_config = {
+        'size': (200, 320),
+    }
+    env = ld.environment(args.trace_path, trace_config, car_config, sensor_config, args.reward_function,
+                         trace_cache_dir=args.trace_cache)
+
+    seed_everything(args.seed)
+    state = env.reset()['camera_front']
+    observations = [state]
+    actions, rewards, dones, distances = [], [], [], []
+
+    done = False
+    while not done and len(actions) < args.max_steps:
+        state_tensor = torch.from_numpy(state).unsqueeze(0).to(ld.device)
+        action_idx = env.epsilon_greedy_action(state_tensor, args.epsilon)
+        next_state, reward, done, info = env.step(env.action_space[action_idx])
+        state = next_state['camera_front']
+
+        observations.append(state)
+        actions.append(action_idx)
+        rewards.append(reward)
+        dones.append(done)
+        distances.append(info['distance'])
+
+    np.savez_compressed(args.output,
+                        seed=args.seed,
+                        action_idx=np.array(actions, dtype=np.int64),
+                        observations=np.stack(observations),
+                        rewards=np.array(rewards, dtype=np.float32),
+                        dones=np.array(dones, dtype=bool),
+                        distances=np.array(distances, dtype=np.float64))
+    print(f'Recorded {len(actions)} steps to {args.output}')
+
+
+def replay_once(args):
+    """
+    One measured run, in its own process so that its peak RSS is its own
+    """
+    episode = dict(np.load(args.episode))
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    env = RecordedEnvironment(episode)
+    seed_everything(int(episode['seed']))
+    replay_buffer = ld.ReplayBuffer(10000)
+
+    # timing wrappers around the store and update steps of the training loop
+    update_latencies = []
+    measured_steps = 0
+    start = time.perf_counter() if args.warmup_updates == 0 else None
+
+    def store(transition):
+        nonlocal measured_steps
+        replay_buffer.store(transition)
+        if start is not None:
+            measured_steps += 1
+
+    def update(sync_target):
+        nonlocal start
+        optimizes = replay_buffer.size() >= args.batch_size
+        update_start = time.perf_counter()
+        ld.update_networks(replay_buffer, args.batch_size, 0.99, sync_target)
+        if optimizes:
+            update_latencies.append(time.perf_counter() - update_start)
+            # start measuring once the warm-up updates are done
+            if start is None and len(update_latencies) == args.warmup_updates:
+                start = time.perf_counter()
+
+    for _ in range(args.passes):
+        ld.run_episode(env, 0., len(env.recorded_actions), TARGET_UPDATE, store, update)
+
+    if start is None or measured_steps == 0:
+        raise SystemExit(f'the episode only gives {len(update_latencies)} updates, lower --warmup-updates '
+                         f'or --batch-size, or raise --passes')
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(update_latencies[args.warmup_updates:]) * 1000
+    return {
+        'steps_per_sec': measured_steps / elapsed,
+        'update_p50_ms': float(np.percentile(latencies_ms, 50)),
+        'update_p90_ms': float(np.percentile(latencies_ms, 90)),
+        'update_p99_ms': float(np.percentile(latencies_ms, 99)),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def replay(args):
+    """
+    Returns the median of every metric over the runs and its [min, max] over the runs
+    """
+    with mp.get_context('spawn').Pool(processes=1, maxtasksperchild=1) as pool:
+        runs = [pool.apply(replay_once, (args,)) for _ in range(args.repeats)]
+
+    results, spread = {}, {}
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        results[name] = float(np.median(values))
+        spread[name] = [float(min(values)), float(max(values))]
+    return results, spread
+
+
+def compare(results, spread, baseline, threshold):
+    """
+    Returns the names of the metrics whose median regressed by more than threshold (a fraction)
+    while all of their runs are worse than all of the baseline's runs
+    steps_per_sec regresses when it drops, every other metric when it grows
+    """
+    baseline_spread = baseline.get('spread', {})
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        low, high = spread[name]
+        baseline_low, baseline_high = baseline_spread.get(name, (reference, reference))
+        if name == 'steps_per_sec':
+            regressed = value < reference * (1 - threshold) and high < baseline_low
+        else:
+            regressed = value > reference * (1 + threshold) and low > baseline_high
+        change = (value - reference) / reference * 100 if reference else 0.
+        print(f'{name:>15}: {value:10.2f}  baseline {reference:10.2f}  ({change:+.1f}%)  '
+              f'runs {low:.2f}-{high:.2f}, baseline runs {baseline_low:.2f}-{baseline_high:.2f}'
+              f'{"  REGRESSED" if regressed else ""}')
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record an episode or replay it as a performance regression test')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='Record a canonical episode from VISTA')
+    record_parser.add_argument('--trace-path', type=str, nargs='+', required=True,
+                               help='Path to the traces to use for simulation')
+    record_parser.add_argument('--reward-function', type=int, nargs='+', default=[1])
+    record_parser.add_argument('--output', type=str, default='perf_episode.npz',
+                               help='Where to save the recorded episode')
+    record_parser.add_argument('--seed', type=int, default=0)
+    record_parser.add_argument('--epsilon', type=float, default=0.5,
+                               help='Exploration rate of the policy used while recording')
+    record_parser.add_argument('--max-steps', type=int, default=700)
+    record_parser.add_argument('--trace-cache', type=str, default=None,
+                               help='Directory of preprocessed traces shared with lane_keeping_d3qn.py --trace-cache')
+
+    replay_parser = subparsers.add_parser('replay', help='Replay a recorded episode and check for regressions')
+    replay_parser.add_argument('--episode', type=str, default='perf_episode.npz',
+                               help='Episode saved by the record command')
+    replay_parser.add_argument('--baseline', type=str, default='perf_baseline.json',
+                               help='Baseline metrics to compare against')
+    replay_parser.add_argument('--update-baseline', action='store_true',
+                               help='Write the measured metrics to --baseline instead of comparing')
+    replay_parser.add_argument('--threshold', type=float, default=0.10,
+                               help='Allowed relative regression of the median of every metric, e.g. 0.10 for 10%%')
+    replay_parser.add_argument('--batch-size', type=int, default=128)
+    replay_parser.add_argument('--passes', type=int, default=1,
+                               help='Number of times the episode is replayed within a run')
+    replay_parser.add_argument('--repeats', type=int, default=5,
+                               help='Number of independent runs, the median of every metric is reported')
+    replay_parser.add_argument('--warmup-updates', type=int, default=10,
+                               help='Updates at the start of every run that are not measured')
+    replay_parser.add_argument('--threads', type=int, default=0,
+                               help='torch intra-op threads, 0 keeps the torch default')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args)
+        sys.exit(0)
+
+    results, spread = replay(args)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(dict(results, spread=spread), file, indent=4)
+        print(f'Saved baseline to {args.baseline}: {results}')
+        sys.exit(0)
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = compare(results, spread, baseline, args.threshold)
+    if regressions:
+        print(f'Performance regression in: {", ".join(regressions)}')
+        sys.exit(1)
+    print('No performance regressions')
@@ -0,0 +1,148 @@
+import argparse
+import copy
+import io
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao import quantization as tq
+
+from distill import latency_ms, load_frames, load_q_network
+
+"""
+Post-training int8 quantization of a trained DQN / DuelingDDQN for CPU inference
+
+The conv stack is statically quantized, with activation ranges calibrated on recorded frames,
+and the fully connected layers (fc1 and the 6191-action output) are dynamically quantized.
+The quantized policy is saved as TorchScript, and the script reports how often it picks the
+same greedy action as the fp32 model on held-out frames along with the size and latency change.
+"""
+class QuantizablePolicy(nn.Module):
+    """
+    Same computation as DQN / DuelingDDQN, with quant/dequant stubs around the conv stack
+    ReLU is applied before max pooling, which gives the same result since both are monotonic,
+    so every conv can be fused with its ReLU
+    """
+    def __init__(self, model):
+        super(QuantizablePolicy, self).__init__()
+        model = copy.deepcopy(model).cpu().eval()
+
+        self.quant = tq.QuantStub()
+        self.conv1, self.relu1, self.pool1 = model.conv1, nn.ReLU(), model.pool1
+        self.conv2, self.relu2, self.pool2 = model.conv2, nn.ReLU(), model.pool2
+        self.conv3, self.relu3, self.pool3 = model.conv3, nn.ReLU(), model.pool3
+        self.dequant = tq.DeQuantStub()
+
+        self.fc1 = model.fc1
+        self.dueling = hasattr(model, 'value_stream')
+        if self.dueling:
+            self.value_stream = model.value_stream
+            self.advantage_stream = model.advantage_stream
+        else:
+            self.fc2 = model.fc2
+
+    def forward(self, state):
+        x = self.quant(state.float() / 255.0)
+        x = self.pool1(self.relu1(self.conv1(x)))
+        x = self.pool2(self.relu2(self.conv2(x)))
+        x = self.pool3(self.relu3(self.conv3(x)))
+        x = self.dequant(x)
+
+        x = x.reshape(x.size(0), -1)
+        x = F.relu(self.fc1(x))
+        if self.dueling:
+            value = self.value_stream(x)
+            advantage = self.advantage_stream(x)
+            return value + advantage - advantage.mean(dim=1, keepdim=True)
+        return F.relu(self.fc2(x))
+
+    def fully_connected(self):
+        return [self.fc1, self.value_stream, self.advantage_stream] if self.dueling else [self.fc1, self.fc2]
+
+
+def quantize(model, calibration_frames, backend, batch_size=32):
+    torch.backends.quantized.engine = backend
+
+    policy = QuantizablePolicy(model)
+    policy = tq.fuse_modules(policy, [['conv1', 'relu1'], ['conv2', 'relu2'], ['conv3', 'relu3']])
+
+    # static quantization for the conv stack only, the linear layers are quantized dynamically below
+    policy.qconfig = tq.get_default_qconfig(backend)
+    for layer in policy.fully_connected():
+        layer.qconfig = None
+    tq.prepare(policy, inplace=True)
+    with torch.no_grad():
+        for i in range(0, len(calibration_frames), batch_size):
+            policy(calibration_frames[i:i+batch_size])
+    tq.convert(policy, inplace=True)
+
+    return tq.quantize_dynamic(policy, {nn.Linear}, dtype=torch.qint8)
+
+
+def serialized_bytes(obj):
+    buffer = io.BytesIO()
+    if isinstance(obj, torch.jit.ScriptModule):
+        torch.jit.save(obj, buffer)
+    else:
+        torch.save(obj, buffer)
+    return len(buffer.getvalue())
+
+
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in engines:
+            return backend
+    raise RuntimeError(f'no int8 quantization backend available, supported engines: {engines}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a trained Q-network to int8 for CPU inference')
+    parser.add_argument('--model', type=str, required=True,
+                        help='Path to the trained state dict (.pth)')
+    parser.add_argument('--arch', type=str, default='d3qn', choices=('d3qn', 'dqn'))
+    parser.add_argument('--frames', type=str, nargs='+', required=True,
+                        help='Recorded episodes (.npz from perf_harness.py record) for calibration and verification')
+    parser.add_argument('--calibration-frames', type=int, default=200,
+                        help='Number of frames used to calibrate the activation ranges, the rest are held out')
+    parser.add_argument('--output', type=str, default='quantized_nn_model.pt',
+                        help='Where to save the quantized TorchScript model')
+    parser.add_argument('--backend', type=str, default=None,
+                        help='Quantized engine (x86, fbgemm or qnnpack), picked automatically by default')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch intra-op threads for the latency measurement, 0 keeps the torch default')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+
+    model = load_q_network(args.arch, args.model, device)
+
+    frames = load_frames(args.frames)
+    frames = frames[torch.randperm(len(frames), generator=torch.Generator().manual_seed(0))]
+    calibration_frames = frames[:args.calibration_frames]
+    holdout_frames = frames[args.calibration_frames:]
+    if len(holdout_frames) == 0:
+        parser.error(f'all {len(frames)} frames are used for calibration, lower --calibration-frames or record more')
+
+    quantized = quantize(model, calibration_frames, args.backend or default_backend())
+
+    with torch.no_grad():
+        fp32_actions = torch.cat([model(holdout_frames[i:i+32]).argmax(dim=1) for i in range(0, len(holdout_frames), 32)])
+        int8_actions = torch.cat([quantized(holdout_frames[i:i+32]).argmax(dim=1) for i in range(0, len(holdout_frames), 32)])
+    agreement = (fp32_actions == int8_actions).float().mean()
+
+    scripted = torch.jit.trace(quantized, holdout_frames[:1])
+    torch.jit.save(scripted, args.output)
+    # time the fp32 model as a trace too, so the speedup is not partly the eager Python overhead
+    scripted_fp32 = torch.jit.trace(model, holdout_frames[:1])
+
+    fp32_bytes = serialized_bytes(model.state_dict())
+    int8_bytes = serialized_bytes(scripted)
+    fp32_latency = latency_ms(scripted_fp32, holdout_frames[0], device)
+    int8_latency = latency_ms(scripted, holdout_frames[0], device)
+
+    print(f'Greedy action agreement on {len(holdout_frames)} held-out frames: {agreement * 100:.1f}%')
+    print(f'Size: {fp32_bytes / 2**20:.1f} MB -> {int8_bytes / 2**20:.1f} MB ({fp32_bytes / int8_bytes:.1f}x smaller)')
+    print(f'Latency: {fp32_latency:.2f} ms -> {int8_latency:.2f} ms per frame ({fp32_latency / int8_latency:.1f}x faster)')
+    print(f'Saved quantized model to {args.output}')
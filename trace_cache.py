@@ -0,0 +1,141 @@
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import time
+
+try:
+    import vista
+except ImportError:
+    vista = None
+
+"""
+Persistent cache of preprocessed VISTA traces
+
+Building a vista.World decodes and indexes every trace before the first step. The cache
+pickles each preprocessed trace once, keyed by trace path, modification time, trace_config
+and VISTA version. The large arrays are stored out-of-band (pickle protocol 5) and aligned
+in the cache file, so later runs memory-map the file and the arrays are views of the
+mapping instead of being rebuilt or copied. The mapping is copy-on-write, so every worker
+process shares the same page cache until it writes to an array.
+"""
+MAGIC = b'VTRACE01'
+ALIGNMENT = 64
+
+
+def trace_mtime(trace_path):
+    """
+    Latest modification time of the trace directory and the files in it
+    """
+    latest = os.path.getmtime(trace_path)
+    for root, _, files in os.walk(trace_path):
+        for name in files:
+            latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+    return latest
+
+
+def trace_cache_key(trace_path, trace_config):
+    payload = json.dumps({
+        'path': trace_path,
+        'mtime': trace_mtime(trace_path),
+        'config': trace_config,
+        'vista': getattr(vista, '__version__', None),
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_trace(trace, cache_path):
+    buffers = []
+    data = pickle.dumps(trace, protocol=5, buffer_callback=buffers.append)
+    raw_buffers = [buffer.raw() for buffer in buffers]
+
+    # file layout: magic, header lengths, json header, pickle stream, then the out-of-band
+    # buffers, each aligned so the arrays mapped from them are aligned too
+    sizes, offsets, offset = [], [], 0
+    for raw in raw_buffers:
+        sizes.append(raw.nbytes)
+        offsets.append(offset)
+        offset = _aligned(offset + raw.nbytes)
+    meta_bytes = json.dumps({'sizes': sizes, 'offsets': offsets}).encode()
+    buffers_start = _aligned(len(MAGIC) + 16 + len(meta_bytes) + len(data))
+
+    # write to a temporary file first so concurrent workers never read a partial cache entry
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack('<QQ', len(meta_bytes), len(data)))
+        file.write(meta_bytes)
+        file.write(data)
+        for raw, start in zip(raw_buffers, offsets):
+            file.seek(buffers_start + start)
+            file.write(raw)
+    os.replace(tmp_path, cache_path)
+
+
+def load_trace(cache_path):
+    with open(cache_path, 'rb') as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    if mapping[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{cache_path} is not a trace cache file')
+    meta_len, data_len = struct.unpack('<QQ', mapping[len(MAGIC):len(MAGIC) + 16])
+    meta_start = len(MAGIC) + 16
+    data_start = meta_start + meta_len
+    meta = json.loads(mapping[meta_start:data_start])
+    buffers_start = _aligned(data_start + data_len)
+
+    view = memoryview(mapping)
+    buffers = [view[buffers_start + start:buffers_start + start + size]
+               for start, size in zip(meta['offsets'], meta['sizes'])]
+    return pickle.loads(view[data_start:data_start + data_len], buffers=buffers)
+
+
+def cached_trace(trace_path, trace_config, cache_dir):
+    cache_path = os.path.join(cache_dir, trace_cache_key(trace_path, trace_config) + '.trace')
+    if os.path.exists(cache_path):
+        try:
+            return load_trace(cache_path)
+        except (ValueError, EOFError, struct.error, pickle.UnpicklingError) as error:
+            print(f'Rebuilding trace {trace_path}, its cache entry is unreadable: {error}')
+
+    # preprocess the trace the same way vista.World does and keep it for the next runs
+    trace = vista.World([trace_path], trace_config).traces[0]
+    try:
+        save_trace(trace, cache_path)
+    except (pickle.PicklingError, TypeError, AttributeError, OSError) as error:
+        print(f'Could not cache trace {trace_path}: {error}')
+    return trace
+
+
+def exposes_traces(world):
+    """
+    Whether world.traces is the world's own list, the cached traces are added to an empty world through it
+    """
+    traces = getattr(world, 'traces', None)
+    return isinstance(traces, list) and traces is world.traces
+
+
+def load_world(trace_paths, trace_config, cache_dir):
+    """
+    Drop-in replacement for vista.World(trace_paths, trace_config) that reads the
+    preprocessed traces from cache_dir, building and caching the missing ones
+    """
+    start = time.time()
+    trace_paths = [os.path.abspath(os.path.expanduser(trace_path)) for trace_path in trace_paths]
+
+    # check before building anything, so the fallback builds every trace only once
+    world = vista.World([], trace_config)
+    if not exposes_traces(world):
+        print('vista.World does not expose its trace list, not using the trace cache')
+        return vista.World(trace_paths, trace_config)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    world.traces.extend(cached_trace(trace_path, trace_config, cache_dir) for trace_path in trace_paths)
+
+    print(f'Loaded {len(trace_paths)} traces in {time.time() - start:.2f}s (cache: {cache_dir})')
+    return world
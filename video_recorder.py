@@ -0,0 +1,99 @@
+import os
+import queue
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import numpy as np
+import cv2
+
+"""
+Asynchronous video recorder for evaluation runs
+
+Rendered frames are handed to a separate encoder process that writes them to an MP4 file, so
+the policy loop never waits on the encoder. The queue in front of it is bounded and frames are
+dropped instead of blocking when the encoder falls behind, a feeder thread moves the queued
+frames into the encoder's stdin. The encoder runs this file as a script, so it only imports
+cv2 and numpy and never re-runs the policy script with its torch, VISTA and CUDA setup, and it
+ignores Ctrl-C so that it can still finish the file after the policy loop was interrupted.
+"""
+FRAME_HEADER = struct.Struct('<III')
+
+
+def encode_frames(path, fps, stream):
+    # Ctrl-C reaches the whole process group, the parent stops the encoder by closing the pipe instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    writer = None
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            break
+        shape = FRAME_HEADER.unpack(header)
+        data = stream.read(shape[0] * shape[1] * shape[2])
+        if len(data) < shape[0] * shape[1] * shape[2]:
+            break
+        frame = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+        if writer is None:
+            height, width = shape[:2]
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        # vista renders RGB, OpenCV writes BGR
+        writer.write(np.ascontiguousarray(frame[:, :, ::-1]))
+    if writer is not None:
+        writer.release()
+
+
+class VideoRecorder:
+    def __init__(self, path, fps=30, every_k=1, max_queue=64):
+        self.path = path
+        self.every_k = every_k
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), path, str(fps)],
+                                        stdin=subprocess.PIPE)
+        self.frames = queue.Queue(maxsize=max_queue)
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+        self.queued = 0
+        self.dropped = 0
+
+    def _feed(self):
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                frame = np.ascontiguousarray(frame, dtype=np.uint8)
+                self.process.stdin.write(FRAME_HEADER.pack(*frame.shape))
+                self.process.stdin.write(frame.data)
+            self.process.stdin.close()
+        except BrokenPipeError:
+            print(f'Video encoder for {self.path} exited early')
+
+    def wants(self, step):
+        """
+        Whether the frame of this step is recorded, lets the caller skip rendering the others
+        """
+        return step % self.every_k == 0
+
+    def write(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # the end marker must not be dropped, wait for room in the queue while the feeder is alive
+        while self.feeder.is_alive():
+            try:
+                self.frames.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.feeder.join()
+        self.process.wait()
+        print(f'Saved {self.queued} frames to {self.path} ({self.dropped} dropped)')
+
+
+if __name__ == '__main__':
+    encode_frames(sys.argv[1], float(sys.argv[2]), sys.stdin.buffer)